@@ -5,13 +5,113 @@
 # SPDX-License-Identifier: MIT
 # Created: 2019-07-07T23:56:25+0200
 # Last modified: 2021-03-14T09:18:26+0100
-"""Python bindings for some FreeBSD library calls on 64-bit architectures."""
+"""
+Python bindings for some FreeBSD library calls on 64-bit architectures.
 
-import ctypes
-import ctypes.util
+sysctl, sysctlbyname, sysctl_many and the readers from make_sysctl_reader
+use per-thread buffers, and the shared MIB cache is filled under a lock, so
+these can be used from several threads. The GIL is released while the C
+library is called, so such threads query sysctls concurrently. Other
+functions, like setproctitle, make no such guarantee.
+"""
 
-# Load the C library
-_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+import atexit
+import ctypes
+import os
+import struct
+import threading
+from errno import ENOENT, ENOMEM
+from functools import cache, lru_cache
+
+
+def _configure_prototypes(lib):
+    """Declare argument and return types of the libc functions used here."""
+    c_size_p = ctypes.POINTER(ctypes.c_size_t)
+    lib.sysctl.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_uint,
+        ctypes.c_void_p,
+        c_size_p,
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+    ]
+    lib.sysctl.restype = ctypes.c_int
+    lib.sysctlbyname.argtypes = [
+        ctypes.c_char_p,
+        ctypes.c_void_p,
+        c_size_p,
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+    ]
+    lib.sysctlbyname.restype = ctypes.c_int
+    lib.sysctlnametomib.argtypes = [ctypes.c_char_p, ctypes.c_void_p, c_size_p]
+    lib.sysctlnametomib.restype = ctypes.c_int
+    lib.getosreldate.argtypes = []
+    lib.getosreldate.restype = ctypes.c_int
+    lib.setproctitle.argtypes = [ctypes.c_char_p, ctypes.c_char_p]
+    lib.setproctitle.restype = None
+    lib.ntp_gettime.argtypes = [ctypes.POINTER(Ntptimeval)]
+    lib.ntp_gettime.restype = ctypes.c_int
+
+
+def _load_libc():
+    """Load the C library. This is deferred until it is first needed."""
+    global _libc
+    import ctypes.util
+
+    lib = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _configure_prototypes(lib)
+    _libc = lib
+    return lib
+
+
+def _get_libc():
+    """Return the C library, loading it if necessary."""
+    try:
+        return _libc
+    except NameError:
+        return _load_libc()
+
+
+def __getattr__(name):
+    """Load the C library on first access of “_libc” (PEP 562)."""
+    if name == "_libc":
+        return _load_libc()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Pre-compiled unpackers for the common integer sizes.
+_U32 = struct.Struct("<I").unpack_from
+_U64 = struct.Struct("<Q").unpack_from
+
+# Cache of MIB vectors and their lengths, keyed by sysctl name.
+_mib_cache = {}
+# The MIB cache is persisted in this file between runs, see _load_mib_cache.
+_mib_cache_path = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "py-freebsd",
+    "mib.json",
+)
+_mib_cache_loaded = False
+_mib_cache_dirty = False
+# Kernel release and boot time the saved cache is valid for, see _mib_cache_key.
+_mib_cache_key_value = None
+# Guards filling the MIB cache. Reading it does not need the lock.
+_mib_lock = threading.Lock()
+
+# ctypes integer array types, keyed by length.
+_int_arr_types = {}
+
+# Per-thread scratch buffer for sysctl data, see _scratch.
+_tls = threading.local()
+
+
+def _int_array(n):
+    """Return the (cached) ctypes type for an array of n ints."""
+    arr_t = _int_arr_types.get(n)
+    if arr_t is None:
+        arr_t = _int_arr_types[n] = ctypes.c_int * n
+    return arr_t
 
 
 def sysctlnametomib(name):
@@ -25,12 +125,10 @@ def sysctlnametomib(name):
         A ctypes array containing the MIB vector.
     """
     ln = name.count(".") + 1
-    mib_t = ctypes.c_int * ln
-    mib = mib_t()
-    size_t = ctypes.c_size_t * 1
-    size = size_t(ln)
-    name_in = ctypes.c_char_p(bytes(name, encoding="ascii"))
-    rv = _libc.sysctlnametomib(name_in, ctypes.byref(mib), ctypes.byref(size))
+    mib = _int_array(ln)()
+    size = ctypes.c_size_t(ln)
+    name_in = bytes(name, encoding="ascii")
+    rv = _get_libc().sysctlnametomib(name_in, ctypes.byref(mib), ctypes.byref(size))
     if rv != 0:
         errno = ctypes.get_errno()
         raise ValueError(f"sysctlnametomib error: {errno}")
@@ -41,47 +139,209 @@ def auto(data):
     """Convert data returned from a sysctl based on the content
 
     Arguments:
-        data: string of bytes
+        data: bytes-like object
     """
-    if len(data) in [4, 8]:
+    n = len(data)
+    if n == 4 or n == 8:
         return to_int(data)
-    if data.endswith(b"\x00") and sum(1 for j in data if j == 0) == 1:
+    data = bytes(data)
+    if n and data[-1] == 0 and data.count(b"\x00") == 1:
         return to_string(data)
     return data
 
 
-def _internal_sysctl(mib, namelen, convert):
-    """Common parts of sysctl and sysctlbyname factored out."""
-    # Retrieve the length of the necessary data buffer
-    datasize = ctypes.c_size_t()
-    rv = _libc.sysctl(
-        ctypes.byref(mib),
-        namelen,
-        None,
-        ctypes.byref(datasize),
-        None,
-        ctypes.c_size_t(0),
-    )
-    # Retrieve the data
-    oldlen = ctypes.c_size_t(datasize.value)
-    oldp = ctypes.create_string_buffer(datasize.value)
-    rv = _libc.sysctl(
-        ctypes.byref(mib),
-        namelen,
-        ctypes.byref(oldp),
-        ctypes.byref(oldlen),
-        None,
-        ctypes.c_size_t(0),
-    )
-    if rv != 0:
+class _Buffer:
+    """Data buffer and its length argument for sysctl(3)."""
+
+    __slots__ = ("buf", "oldlen")
+
+    def __init__(self, size):
+        self.buf = (ctypes.c_char * size)()
+        self.oldlen = ctypes.c_size_t()
+
+
+def _scratch():
+    """Return the scratch buffer for this thread, creating it if needed."""
+    try:
+        return _tls.buffer
+    except AttributeError:
+        b = _tls.buffer = _Buffer(256)
+        return b
+
+
+def _read(sysctl, mib, namelen, b):
+    """
+    Read a sysctl into a _Buffer, growing it when necessary.
+
+    Try to retrieve the data straight into the buffer. Only when that is too
+    small, ask for the necessary size, grow it and try again.
+
+    Returns:
+        0 on success, otherwise the errno value.
+    """
+    oldlen = b.oldlen
+    while True:
+        oldp = b.buf
+        oldlen.value = len(oldp)
+        rv = sysctl(
+            ctypes.byref(mib),
+            namelen,
+            ctypes.byref(oldp),
+            ctypes.byref(oldlen),
+            None,
+            0,
+        )
+        if rv == 0:
+            return 0
         errno = ctypes.get_errno()
-        raise ValueError(f"sysctl error: {errno}")
+        if errno != ENOMEM:
+            return errno
+        rv = sysctl(
+            ctypes.byref(mib),
+            namelen,
+            None,
+            ctypes.byref(oldlen),
+            None,
+            0,
+        )
+        if rv != 0:
+            return ctypes.get_errno()
+        # The size may change between calls, so always grow substantially.
+        b.buf = (ctypes.c_char * max(oldlen.value, 2 * len(oldp)))()
+
+
+def _internal_sysctl(mib, namelen, convert, zero_copy=False, name=None):
+    """
+    Common parts of sysctl and sysctlbyname factored out.
+
+    If name is given, the MIB came from the cache. When the kernel no longer
+    knows that MIB, the name is resolved again once.
+    """
+    sysctl = _get_libc().sysctl
+    raw = zero_copy and convert is None
+    while True:
+        if raw:
+            # A fresh buffer of the needed size, so the view pins only that.
+            b = _Buffer(0)
+            rv = sysctl(
+                ctypes.byref(mib), namelen, None, ctypes.byref(b.oldlen), None, 0
+            )
+            if rv == 0:
+                b.buf = (ctypes.c_char * b.oldlen.value)()
+        else:
+            b = _scratch()
+        errno = _read(sysctl, mib, namelen, b)
+        if errno == 0:
+            break
+        if errno != ENOENT or name is None:
+            raise ValueError(f"sysctl error: {errno}")
+        # The cached MIB is stale, e.g. after a kld was reloaded.
+        mib, namelen = _refresh_mib(name, mib)
+        name = None
+    if raw:
+        return memoryview(b.buf).cast("B")[: b.oldlen.value].toreadonly()
+    # Copy the data out of the scratch buffer only once.
+    data = memoryview(b.buf)[: b.oldlen.value].tobytes()
     if convert:
-        return convert(oldp.raw)
-    return oldp.raw
+        return convert(data)
+    return data
 
 
-def sysctlbyname(name, convert=auto):
+def _mib_cache_key():
+    """
+    Return the kernel release and boot time the MIB cache is valid for.
+
+    Nodes registered with OID_AUTO get their numbers at boot or kld load time,
+    so a saved MIB is only trusted for the same kernel and boot. The key is
+    computed once per process.
+    """
+    global _mib_cache_key_value
+    if _mib_cache_key_value is None:
+        # kern.boottime has the fixed MIB {CTL_KERN, KERN_BOOTTIME}.
+        mib = _int_array(2)(1, 21)
+        boottime = _internal_sysctl(mib, 2, None)
+        _mib_cache_key_value = [os.uname().release, boottime.hex()]
+    return _mib_cache_key_value
+
+
+def _load_mib_cache():
+    """
+    Fill the MIB cache from disk.
+
+    The file is only used when it was written for the running kernel and
+    boot, see _mib_cache_key. Any problem reading it is ignored.
+    """
+    global _mib_cache_loaded
+    import json
+
+    _mib_cache_loaded = True
+    try:
+        with open(_mib_cache_path) as f:
+            data = json.load(f)
+        if data["key"] != _mib_cache_key():
+            return
+        for name, mib in data["mibs"].items():
+            _mib_cache.setdefault(name, (_int_array(len(mib))(*mib), len(mib)))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+
+
+def _save_mib_cache():
+    """Write the MIB cache to disk if it was changed."""
+    if not _mib_cache_dirty:
+        return
+    import json
+
+    with _mib_lock:
+        mibs = {name: list(mib) for name, (mib, _) in _mib_cache.items()}
+    tmp = f"{_mib_cache_path}.{os.getpid()}"
+    try:
+        data = {"key": _mib_cache_key(), "mibs": mibs}
+        os.makedirs(os.path.dirname(_mib_cache_path), exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, _mib_cache_path)
+    except (OSError, ValueError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+atexit.register(_save_mib_cache)
+
+
+def _lookup_mib(name):
+    """Return the (cached) MIB vector and its length for a sysctl name."""
+    global _mib_cache_dirty
+    entry = _mib_cache.get(name)
+    if entry is not None:
+        return entry
+    with _mib_lock:
+        if not _mib_cache_loaded:
+            _load_mib_cache()
+        entry = _mib_cache.get(name)
+        if entry is None:
+            mib = sysctlnametomib(name)
+            # The kernel only reads the MIB, so it is safe to reuse.
+            entry = (mib, len(mib))
+            _mib_cache[name] = entry
+            _mib_cache_dirty = True
+    return entry
+
+
+def _refresh_mib(name, stale):
+    """Drop a stale MIB for name from the cache and resolve the name again."""
+    global _mib_cache_dirty
+    with _mib_lock:
+        entry = _mib_cache.get(name)
+        if entry is not None and entry[0] is stale:
+            del _mib_cache[name]
+            _mib_cache_dirty = True
+    return _lookup_mib(name)
+
+
+def sysctlbyname(name, convert=auto, zero_copy=False):
     """
     Python wrapper for sysctlbyname(3).
 
@@ -90,16 +350,127 @@ def sysctlbyname(name, convert=auto):
         convert: Function to convert the data.
             Defaults to “convert=auto” for automatic conversion.
             Use “convert=None” for no conversion.
+        zero_copy (bool): If true and “convert=None”, return a read-only
+            memoryview instead of bytes. This avoids copying large results.
+            The view keeps the underlying buffer alive.
 
     Returns:
         The requested binary data, converted if desired.
     """
-    mib = sysctlnametomib(name)
-    namelen = ctypes.c_uint(len(mib))
-    return _internal_sysctl(mib, namelen, convert=convert)
+    mib, namelen = _lookup_mib(name)
+    return _internal_sysctl(
+        mib, namelen, convert=convert, zero_copy=zero_copy, name=name
+    )
+
+
+def sysctl_many(names, convert=auto):
+    """
+    Query several sysctls by name.
+
+    This still does one sysctl(3) call per name, but the buffer and the
+    ctypes arguments for it are set up only once.
+
+    Arguments:
+        names: Iterable of sysctl names.
+        convert: Function to convert the data, applied to every result.
+            Defaults to “convert=auto” for automatic conversion.
+            Use “convert=None” for no conversion.
+
+    Returns:
+        A list of the requested data, in the same order as names.
+    """
+    sysctl = _get_libc().sysctl
+    b = _scratch()
+    oldlen = b.oldlen
+    oldlen_p = ctypes.byref(oldlen)
+    byref, lookup = ctypes.byref, _lookup_mib
+    size = 0
+    rv = []
+    for name in names:
+        if size != len(b.buf):
+            # (Re)bind after the buffer was grown by _internal_sysctl.
+            oldp = b.buf
+            size = len(oldp)
+            oldp_p = byref(oldp)
+            view = memoryview(oldp)
+        mib, namelen = lookup(name)
+        oldlen.value = size
+        if sysctl(byref(mib), namelen, oldp_p, oldlen_p, None, 0):
+            # Buffer too small or stale MIB; let the general code handle it.
+            rv.append(_internal_sysctl(mib, namelen, convert, name=name))
+            continue
+        data = view[: oldlen.value].tobytes()
+        rv.append(convert(data) if convert else data)
+    return rv
 
 
-def sysctl(name, convert=auto):
+def make_sysctl_reader(name, convert=auto):
+    """
+    Create a function that queries a single sysctl.
+
+    This is meant for polling the same sysctl repeatedly. The MIB and the
+    ctypes arguments are set up once. Every thread that calls the reader gets
+    its own data buffer, which grows when the data does.
+
+    Arguments:
+        name (str): Name of the sysctl to query
+        convert: Function to convert the data.
+            Defaults to “convert=auto” for automatic conversion.
+            Use “convert=None” for no conversion.
+
+    Returns:
+        A function without arguments that returns the requested data,
+        converted if desired.
+    """
+    sysctl = _get_libc().sysctl
+    # The first read also replaces a stale cached MIB, see _internal_sysctl.
+    initial = len(_internal_sysctl(*_lookup_mib(name), None, name=name))
+    mib, namelen = _lookup_mib(name)
+    target = (mib, namelen, ctypes.byref(mib))
+    local = threading.local()
+
+    def _buffers(size):
+        """Set up the buffer and arguments for this thread."""
+        oldp = (ctypes.c_char * size)()
+        oldlen = ctypes.c_size_t()
+        local.bufs = (
+            size,
+            memoryview(oldp),
+            ctypes.byref(oldp),
+            oldlen,
+            ctypes.byref(oldlen),
+        )
+        return local.bufs
+
+    def _fetch():
+        nonlocal target
+        mib, namelen, mib_p = target
+        try:
+            size, view, oldp_p, oldlen, oldlen_p = local.bufs
+        except AttributeError:
+            size, view, oldp_p, oldlen, oldlen_p = _buffers(initial)
+        oldlen.value = size
+        if sysctl(mib_p, namelen, oldp_p, oldlen_p, None, 0) == 0:
+            return view[: oldlen.value].tobytes()
+        errno = ctypes.get_errno()
+        if errno == ENOENT:
+            # The MIB is stale, e.g. after a kld was reloaded.
+            mib, namelen = _refresh_mib(name, mib)
+            target = (mib, namelen, ctypes.byref(mib))
+            return _internal_sysctl(mib, namelen, None)
+        if errno != ENOMEM:
+            raise ValueError(f"sysctl error: {errno}")
+        # The data has grown; read it the general way and resize the buffer.
+        data = _internal_sysctl(mib, namelen, None)
+        _buffers(max(len(data), 2 * size))
+        return data
+
+    if convert is None:
+        return _fetch
+    return lambda: convert(_fetch())
+
+
+def sysctl(name, convert=auto, zero_copy=False):
     """
     Python wrapper for sysctl(3).
 
@@ -108,57 +479,73 @@ def sysctl(name, convert=auto):
         convert: Function to convert the data.
             Defaults to “convert=auto” for automatic conversion.
             Use “convert=None” for no conversion.
+        zero_copy (bool): If true and “convert=None”, return a read-only
+            memoryview instead of bytes. This avoids copying large results.
+            The view keeps the underlying buffer alive.
 
     Returns:
         The requested data, converted if desired.
     """
-    mib_t = ctypes.c_int * len(name)
-    mib = mib_t(*name)
-    namelen = ctypes.c_uint(len(name))
-    return _internal_sysctl(mib, namelen, convert=convert)
+    mib = _int_array(len(name))(*name)
+    namelen = len(name)
+    return _internal_sysctl(mib, namelen, convert=convert, zero_copy=zero_copy)
+
+
+# Format string for setproctitle(3), and the last name set.
+_proctitle_fmt = ctypes.c_char_p(b"-%s")
+_last_title = None
 
 
 def setproctitle(name):
     """
     Change the name of the process.
 
+    Setting the same name again is a no-op.
+
     Arguments:
         name (bytes/str): the new name for the process.
     """
+    global _last_title
     if isinstance(name, str):
         name = name.encode("ascii")
-    fmt = ctypes.c_char_p(b"-%s")
-    value = ctypes.c_char_p(name)
-    _libc.setproctitle(fmt, value)
+    if name == _last_title:
+        return
+    _get_libc().setproctitle(_proctitle_fmt, name)
+    _last_title = name
 
 
+@cache
 def hostuuid():
     """Returns the UUID of this host."""
-    rv = sysctlbyname("kern.hostuuid", buflen=40, convert=to_string)
+    rv = sysctlbyname("kern.hostuuid", convert=to_string)
     return rv
 
 
+@cache
 def osrelease():
     """Returns operating system release."""
     rv = sysctlbyname("kern.osrelease")
     return rv
 
 
+@cache
 def osrevision():
     """Returns operating system revision."""
     rv = sysctlbyname("kern.osrevision")
     return rv
 
 
+@cache
 def osreldate():
     """
     Returns the version of the currently running FreeBSD kernel.
 
     This is the value of __FreeBSD_version.
     """
-    return _libc.getosreldate()
+    return _get_libc().getosreldate()
 
 
+@cache
 def version():
     """Returns operation system version."""
     rv = sysctlbyname("kern.version")
@@ -169,14 +556,14 @@ def version():
 # ntp_gettime(2) do not match those of /usr/include/sys/timex.h! In this
 # module, I have therefore followed the latter!
 
-_time_state = {
-    0: "TIME_OK",
-    1: "TIME_INS",
-    2: "TIME_DEL",
-    3: "TIME_OOP",
-    4: "TIME_WAIT",
-    5: "TIME_ERROR",
-}
+_time_state = (
+    "TIME_OK",
+    "TIME_INS",
+    "TIME_DEL",
+    "TIME_OOP",
+    "TIME_WAIT",
+    "TIME_ERROR",
+)
 
 
 class Ntptimeval(ctypes.Structure):
@@ -190,10 +577,11 @@ class Ntptimeval(ctypes.Structure):
     ]
 
     def __repr__(self):
-        a = f"Ntptimeval(tv_sec={self.tv_sec}, tv_nsec={self.tv_nsec}, "
-        b = f"maxerror={self.maxerror}, esterror={self.esterror}, "
-        c = f"tai={self.tai}, time_state={_time_state[self.time_state]})"
-        return a + b + c
+        return (
+            f"Ntptimeval(tv_sec={self.tv_sec}, tv_nsec={self.tv_nsec}, "
+            f"maxerror={self.maxerror}, esterror={self.esterror}, "
+            f"tai={self.tai}, time_state={_time_state[self.time_state]})"
+        )
 
 
 def ntp_gettime():
@@ -201,20 +589,31 @@ def ntp_gettime():
     tv = Ntptimeval(0, 0, 0, 0, 0, 0)
     # Note: the return value of ntp_gettime is the same as the time_state
     # member of Ntptimeval. So don't bother returning it separately.
-    _libc.ntp_gettime(ctypes.byref(tv))
+    _get_libc().ntp_gettime(ctypes.byref(tv))
     return tv
 
 
 def to_int(value):
     """Convert binary sysctl value to integer."""
+    n = len(value)
+    if n == 4:
+        return _U32(value)[0]
+    if n == 8:
+        return _U64(value)[0]
     return int.from_bytes(value, byteorder="little")
 
 
 def to_degC(value):
     """Convert binary sysctl value to degree Centigrade."""
-    return round(int.from_bytes(value, byteorder="little") / 10 - 273.15, 1)
+    return round(to_int(value) / 10 - 273.15, 1)
+
+
+@lru_cache(maxsize=64)
+def _decode(value):
+    """Decode NUL-padded bytes; cached since the same values recur often."""
+    return value.strip(b"\x00").decode("utf-8")
 
 
 def to_string(value):
     """Convert binary sysctl value to UTF-8 string."""
-    return value.strip(b"\x00").decode("utf-8")
+    return _decode(bytes(value))